@@ -1,13 +1,60 @@
 """Main application file for the duplicate scanner."""
 
-import hashlib
+import mmap
 import os
+import sqlite3
+import threading
+import time
 import tkinter as tk
+from array import array
+from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from tkinter import filedialog
 
 import dearpygui.dearpygui as dpg
+import numpy as np
+import platformdirs
 import xxhash
 
+# Minimum time between progress bar refreshes
+PROGRESS_INTERVAL_NS = 16_000_000  # ~60 times per second
+
+# Number of bytes read from the start of each file for the pre-hash
+PREHASH_SIZE = 1 << 18  # 256KB
+
+# Files up to this size are pre-hashed in batches of TINY_BATCH_SIZE files
+TINY_FILE_SIZE = 1 << 16  # 64KB
+TINY_BATCH_SIZE = 256
+
+# Files bigger than this are memory mapped when fully hashed
+MMAP_THRESHOLD = 1 << 20  # 1MB
+
+# Size of the buffer used when streaming a file into the hash
+HASH_BLOCK_SIZE = 1 << 20  # 1MB
+
+# Total size of files to full hash before a process pool is used
+PROCESS_POOL_THRESHOLD = 1 << 28  # 256MB
+
+# Divisor and suffix of each file size unit
+FILESIZE_UNITS = (
+    (1, "B"),
+    (1 << 10, "KB"),
+    (1 << 20, "MB"),
+    (1 << 30, "GB"),
+    (1 << 40, "TB"),
+)
+
+# Parallel per-file arrays of a scan, indexed by file number
+ScannedFiles = namedtuple(
+    "ScannedFiles", "paths names sizes mtimes prehashes fullhashes"
+)
+
+# Location of the hash cache reused between scans
+CACHE_PATH = os.path.join(
+    platformdirs.user_cache_dir("Duplicate-Finder", appauthor=False), "hashes.sqlite"
+)
+CACHE_VERSION = 3  # Bump when the stored hashes change format
+
 
 def open_directory_selector():
     """Open a native directory selection dialog."""
@@ -32,37 +79,515 @@ def handle_resize(_, __):
 
 
 def xxhashsum(filename, algo="xxh128"):
-    """Hash the contents of a file using the xxhash algorithm."""
+    """Hash the contents of a file using the xxhash algorithm, as raw bytes."""
     if algo not in xxhash.algorithms_available:
         raise NotImplementedError
-    digest = getattr(xxhash, algo)
+    filehash = getattr(xxhash, algo)()
     with open(filename, "rb", buffering=0) as f:
-        return hashlib.file_digest(f, digest).hexdigest()
+        update_from_file(filehash, f)
+    return filehash.digest()
 
 
-def xxprehashsum(filename, algo="xxh128", size=8**6):  # 256KB
-    """Hash the first `size` bytes of a file using the xxhash algorithm."""
+def xxhashsum_resume(filename, filehash, offset):
+    """Finish hashing a file whose first `offset` bytes are already in `filehash`."""
+    with open(filename, "rb", buffering=0) as f:
+        update_from_file(filehash, f, offset)
+    return filehash.digest()
+
+
+def update_from_file(filehash, f, offset=0):
+    """Feed an open file into a hash object, starting at `offset`."""
+    # Hash big files straight from a memory map in a single call
+    file_size = os.fstat(f.fileno()).st_size
+    if file_size > MMAP_THRESHOLD:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mmap, "MADV_SEQUENTIAL"):  # POSIX only
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                with memoryview(mm)[offset:] as view:
+                    filehash.update(view)
+            return
+        except (OSError, OverflowError):
+            pass  # Too big to map (32-bit builds), stream it instead
+
+    # Stream the file through a single reused buffer, sized to what's left to read
+    f.seek(offset)
+    buffer = bytearray(min(HASH_BLOCK_SIZE, max(file_size - offset, 1)))
+    view = memoryview(buffer)
+    while size := f.readinto(buffer):
+        filehash.update(view[:size])
+
+
+def xxprehashsum(
+    filename, algo="xxh3_64", size=PREHASH_SIZE, prefetch=None, full_algo="xxh128"
+):
+    """Hash the first `size` bytes of a file using the xxhash algorithm.
+
+    The hash is returned as a signed integer so 64-bit hashes fit in SQLite
+    and `array("q")` columns, along with a `full_algo` hash object already fed
+    with the same bytes (None if the whole file fit or `full_algo` is None),
+    which can be finished with `xxhashsum_resume` without reading them again.
+    `prefetch` is an optional file that will be pre-hashed soon, the kernel
+    starts reading it in the background.
+    """
     if algo not in xxhash.algorithms_available:
         raise NotImplementedError
     digest = getattr(xxhash, algo)
+    if prefetch is not None:
+        prefetch_file(prefetch, size)
     with open(filename, "rb", buffering=0) as f:
-        return digest(f.read(size)).hexdigest()
+        data = f.read(size)
+        # Keep the prefix out of the page cache unless the full hash reads it again,
+        # a partial full hash or a file that fit entirely never needs it
+        if hasattr(os, "posix_fadvise") and (full_algo or len(data) < size):
+            os.posix_fadvise(f.fileno(), 0, size, os.POSIX_FADV_DONTNEED)
+    prehash = int.from_bytes(digest(data).digest(), "big", signed=True)
+    if len(data) < size or full_algo is None:
+        return prehash, None
+    return prehash, getattr(xxhash, full_algo)(data)
+
+
+def xxprehashsum_batch(filenames, size=TINY_FILE_SIZE):
+    """Pre-hash many small files at once, the same way as `xxprehashsum`.
+
+    Only meant for files of at most `size` bytes, skips the hash objects and
+    file objects to keep the per-file overhead low.
+    """
+    prehashes = []
+    for filename in filenames:
+        fd = os.open(filename, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        try:
+            data = os.read(fd, size)
+        finally:
+            os.close(fd)
+        prehashes.append(
+            int.from_bytes(xxhash.xxh3_64_digest(data), "big", signed=True)
+        )
+    return prehashes
+
+
+def prefetch_file(filename, size):
+    """Ask the kernel to start reading the first `size` bytes of a file."""
+    if not hasattr(os, "posix_fadvise"):  # POSIX only
+        return
+    try:
+        fd = os.open(filename, os.O_RDONLY)
+    except OSError:
+        return  # The hashing itself reports unreadable files
+    try:
+        os.posix_fadvise(fd, 0, size, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+
+def open_hash_cache():
+    """Open the on-disk hash cache, creating it if needed.
+
+    Returns None if the cache can't be used, the scan then hashes every file.
+    """
+    cache = None
+    try:
+        os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+        cache = sqlite3.connect(CACHE_PATH)
+        cache.execute("PRAGMA journal_mode=WAL")
+
+        # Throw away hashes stored by an older version
+        if cache.execute("PRAGMA user_version").fetchone()[0] != CACHE_VERSION:
+            cache.execute("DROP TABLE IF EXISTS h")
+            cache.execute(f"PRAGMA user_version = {CACHE_VERSION}")
+
+        cache.execute(
+            "CREATE TABLE IF NOT EXISTS h ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER,"
+            " prehash INTEGER, fullhash BLOB"
+            ")"
+        )
+    except (OSError, sqlite3.Error) as error:
+        print(f"Hash cache unavailable: {error}")
+        if cache is not None:
+            cache.close()
+        return None
+    return cache
+
+
+def get_cached_hash(cache, path, size, mtime):
+    """Return the cached pre-hash and full hash of a file, if it didn't change."""
+    row = cache.execute(
+        "SELECT prehash, fullhash FROM h WHERE path=? AND size=? AND mtime=?",
+        (path, size, mtime),
+    ).fetchone()
+    return row or (None, None)
+
+
+def store_cached_hashes(cache, files, indices, prune_directory=None):
+    """Write the hashes of the files at `indices` to the cache.
+
+    With `prune_directory`, the rows of files under it that weren't indexed
+    this time are removed in the same transaction.
+    """
+    rows = (
+        (
+            files.paths[i],
+            files.sizes[i],
+            files.mtimes[i],
+            files.prehashes[i],
+            files.fullhashes[i],
+        )
+        for i in indices
+    )
+    try:
+        with cache:  # Single transaction
+            cache.executemany("INSERT OR REPLACE INTO h VALUES (?, ?, ?, ?, ?)", rows)
+            if prune_directory is not None:
+                prune_cached_hashes(cache, prune_directory, files.paths)
+    except sqlite3.Error as error:
+        # The hashes are only lost for the next scan
+        print(f"Couldn't update the hash cache: {error}")
+
+
+def prune_cached_hashes(cache, directory_path, paths):
+    """Remove the cached hashes of files under a directory that are gone."""
+    # Paths under "dir/" sort before "dir0", the character after the separator
+    prefix = os.path.join(directory_path, "")
+    end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    cached = cache.execute(
+        "SELECT path FROM h WHERE path >= ? AND path < ?", (prefix, end)
+    ).fetchall()
+    seen = set(paths)
+    cache.executemany(
+        "DELETE FROM h WHERE path=?", (row for row in cached if row[0] not in seen)
+    )
+
+
+def scan_files(directory_path):
+    """Yield a `os.DirEntry` for every file under a directory."""
+    # Iterative walk, deep trees don't hit the recursion limit or chain generators
+    stack = [directory_path]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue  # Skip unreadable or removed directories, like os.walk
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file():
+                    yield entry
+
+
+def group_prehashes(indices, sizes, prehashes):
+    """Return the groups of file indices that share both a size and a pre-hash."""
+    if not indices:
+        return []
+
+    # Sort the (size, pre-hash) keys in numpy instead of hashing them one by one
+    indices = np.fromiter(indices, dtype=np.int64, count=len(indices))
+    keys = np.column_stack(
+        (
+            np.frombuffer(sizes, dtype=np.int64)[indices],
+            np.frombuffer(prehashes, dtype=np.int64)[indices],
+        )
+    )
+    _, inverse, counts = np.unique(
+        keys, axis=0, return_inverse=True, return_counts=True
+    )
+    order = np.argsort(inverse.ravel(), kind="stable")
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    duplicated = counts > 1
+    return [
+        indices[order[start:end]].tolist()
+        for start, end in zip(starts[duplicated], ends[duplicated])
+    ]
 
 
 def format_filesize(size):
     """Format the file size in human-readable format."""
-    if size < 1024:
+    # Each unit is 10 bits bigger than the previous one
+    unit_index = min(max(size.bit_length() - 1, 0) // 10, len(FILESIZE_UNITS) - 1)
+    if unit_index == 0:
         return f"{size} B"
-    if size < 1024**2:
-        return f"{size / 1024:.2f} KB"
-    if size < 1024**3:
-        return f"{size / 1024**2:.2f} MB"
-    if size < 1024**4:
-        return f"{size / 1024**3:.2f} GB"
-    return f"{size / 1024**4:.2f} TB"
+    divisor, unit = FILESIZE_UNITS[unit_index]
+    return f"{size / divisor:.2f} {unit}"
+
+
+def progress_reporter(progress_bar_tag, progress_text_tag, total):
+    """Return a callback adding finished files to the progress display.
+
+    The display is refreshed at most every PROGRESS_INTERVAL_NS, and the text
+    only when the whole percentage changes, unless `force` is set.
+    """
+    done = 0
+    last_ui_ns = time.monotonic_ns()
+    last_percentage = -1
+
+    def report_progress(count, force=False):
+        nonlocal done, last_ui_ns, last_percentage
+        done += count
+        now = time.monotonic_ns()
+        if not force and now - last_ui_ns < PROGRESS_INTERVAL_NS:
+            return
+        last_ui_ns = now
+
+        progress_percentage = done / total if total else 1
+        dpg.set_value(progress_bar_tag, progress_percentage)
+        if force or int(progress_percentage * 100) != last_percentage:
+            last_percentage = int(progress_percentage * 100)
+            dpg.set_value(progress_text_tag, f"Processed: {done}/{total}")
+
+    return report_progress
+
+
+def index_files(directory_path, cancelled):
+    """Collect the files under a directory into parallel arrays by file number."""
+    files = ScannedFiles([], [], array("q"), array("q"), array("q"), [])
+    for entry in scan_files(directory_path):
+        if cancelled():
+            break
+        stat = entry.stat()  # Only file stat of the scan, reused everywhere
+        files.paths.append(entry.path)
+        files.names.append(entry.name)
+        files.sizes.append(stat.st_size)
+        files.mtimes.append(stat.st_mtime_ns)
+    files.prehashes.frombytes(bytes(8 * len(files.paths)))
+    files.fullhashes.extend([None] * len(files.paths))
+    return files
+
+
+def find_candidates(sizes):
+    """Return the indices of the files sharing their size with another file."""
+    size_map = defaultdict(list)
+    for index, size in enumerate(sizes):
+        size_map[size].append(index)
+    return [
+        index
+        for size, indices in size_map.items()
+        if size > 0 and len(indices) > 1  # Skip zero-byte files
+        for index in indices
+    ]
+
+
+def load_cached_hashes(cache, files, indices, cancelled):
+    """Fill in the cached hashes of files that didn't change since the last scan.
+
+    Returns the indices with a cached pre-hash and the ones still to pre-hash.
+    """
+    prehashed = []
+    uncached = []
+    for position, index in enumerate(indices):
+        if cancelled():
+            break
+        try:
+            prehash, files.fullhashes[index] = get_cached_hash(
+                cache, files.paths[index], files.sizes[index], files.mtimes[index]
+            )
+        except sqlite3.Error as error:
+            # Hash the rest instead, e.g. if another scan holds the lock
+            print(f"Hash cache unavailable: {error}")
+            uncached += indices[position:]
+            break
+        if prehash is None:
+            uncached.append(index)
+        else:
+            files.prehashes[index] = prehash
+            prehashed.append(index)
+    return prehashed, uncached
+
+
+def submit_prehash_jobs(executor, files, indices, max_workers):
+    """Submit the pre-hash jobs of the files at `indices` to a thread pool.
+
+    Returns the batch futures, mapped to their file indices, and the single file
+    futures, mapped to their file index.
+    """
+    paths, sizes = files.paths, files.sizes
+    tiny = [index for index in indices if sizes[index] <= TINY_FILE_SIZE]
+    other = [index for index in indices if sizes[index] > TINY_FILE_SIZE]
+
+    # Tiny files are hashed in batches, one job per file costs more than them
+    batches = {}
+    for start in range(0, len(tiny), TINY_BATCH_SIZE):
+        batch = tiny[start : start + TINY_BATCH_SIZE]
+        future = executor.submit(xxprehashsum_batch, [paths[index] for index in batch])
+        batches[future] = batch
+
+    # Partial full hashes only help the in-process recheck, which is only used
+    # when the files that could need one add up to little data
+    full_algo = None
+    if sum(sizes[i] for i in other if sizes[i] > PREHASH_SIZE) < PROCESS_POOL_THRESHOLD:
+        full_algo = "xxh128"
+
+    # Each job prefetches the file that a worker will pick up after it
+    prefetch = [paths[index] for index in other[max_workers:]]
+    prefetch += [None] * min(max_workers, len(other))
+    futures = {
+        executor.submit(
+            xxprehashsum,
+            paths[index],
+            prefetch=prefetch[position],
+            full_algo=full_algo,
+        ): index
+        for position, index in enumerate(other)
+    }
+    return batches, futures
+
+
+def prehash_files(files, indices, cancelled, report_progress):
+    """Pre-hash the files at `indices` in a thread pool, the work is mostly disk reads.
+
+    Returns the pre-hashes and the partial full hashes (see `xxprehashsum`) of
+    the files hashed before the scan got cancelled, keyed by file index.
+    """
+    prehashes = {}
+    partial_hashes = {}
+    max_workers = min(32, (os.cpu_count() or 1) * 4)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        batches, futures = submit_prehash_jobs(executor, files, indices, max_workers)
+        for future in as_completed([*batches, *futures]):
+            if cancelled():
+                executor.shutdown(cancel_futures=True)
+                break
+            if future in batches:
+                prehashes.update(zip(batches[future], future.result()))
+                report_progress(len(batches[future]))
+                continue
+
+            index = futures[future]
+            prehashes[index], partial_hash = future.result()
+            if partial_hash is not None:
+                partial_hashes[index] = partial_hash
+            report_progress(1)
+
+    return prehashes, partial_hashes
+
+
+def full_hash_files(files, indices, partial_hashes, cancelled):
+    """Full hash the files at `indices` until the scan gets cancelled.
+
+    Returns the full hashes keyed by file index. Big batches are hashed in
+    parallel processes, small ones aren't worth the startup and continue the
+    partial hashes from `prehash_files` instead.
+    """
+    paths, sizes = files.paths, files.sizes
+    fullhashes = {}
+    if sum(sizes[index] for index in indices) < PROCESS_POOL_THRESHOLD:
+        for index in indices:
+            if cancelled():
+                break
+            if index in partial_hashes:
+                # Continue the partial hash, skipping the pre-hashed bytes
+                fullhashes[index] = xxhashsum_resume(
+                    paths[index], partial_hashes[index], PREHASH_SIZE
+                )
+            else:
+                fullhashes[index] = xxhashsum(paths[index])
+        return fullhashes
+
+    # Hash objects can't be sent to other processes, start from scratch
+    with ProcessPoolExecutor() as executor:
+        results = executor.map(
+            xxhashsum, [paths[index] for index in indices], chunksize=4
+        )
+        for index in indices:
+            if cancelled():
+                executor.shutdown(cancel_futures=True)
+                break
+            fullhashes[index] = next(results)
+    return fullhashes
+
+
+def find_recheck(files, prehash_groups):
+    """Return the files of the pre-hash groups that still need a full hash.
+
+    Files that fit in the pre-hash get it as their full hash instead.
+    """
+    recheck = []
+    for indices in prehash_groups:
+        for index in indices:
+            if files.fullhashes[index] is not None:
+                continue
+            if files.sizes[index] <= PREHASH_SIZE:
+                # The pre-hash already covered the whole file
+                prehash = files.prehashes[index]
+                files.fullhashes[index] = prehash.to_bytes(8, "big", signed=True)
+            else:
+                recheck.append(index)
+    return recheck
+
+
+def group_duplicates(files, prehash_groups):
+    """Return the groups of files with the same full hash, biggest files first."""
+    # Identical files always share a pre-hash group, one map covers them all
+    full_map = defaultdict(list)
+    for indices in prehash_groups:
+        for index in indices:
+            full_map[files.fullhashes[index]].append(index)
+
+    # Only keep actual duplicates
+    duplicate_groups = [matches for matches in full_map.values() if len(matches) > 1]
+    duplicate_groups.sort(key=lambda group: files.sizes[group[0]], reverse=True)
+    return duplicate_groups
+
+
+def show_duplicates(files, duplicate_groups):
+    """Display found duplicates in a table."""
+    with dpg.table(header_row=True, scrollX=True, scrollY=True):
+        dpg.add_table_column(label="File Size", width=10, width_fixed=True)
+        dpg.add_table_column(label="File Paths")
+        # dpg.add_table_column(label="Duplicate File Hash", width=10, width_fixed=True)
+
+        # Populate the table with the file paths and additional file info
+        for group in duplicate_groups:
+            filehash = files.fullhashes[group[0]].hex()
+            group_paths = [files.paths[index] for index in group]
+
+            with dpg.table_row():
+                dpg.add_text(format_filesize(files.sizes[group[0]]))
+                dpg.add_text(
+                    ", ".join([files.names[index] for index in group]),
+                    tag=filehash,
+                )
+                # dpg.add_text(filehash)
 
+                with dpg.tooltip(filehash):
+                    dpg.add_text("\n".join(group_paths))
 
-def scan_directory():
+
+def start_scan():
+    """Start scanning in a background thread so the scan can be cancelled."""
+    cancel_event = threading.Event()
+    dpg.set_item_user_data("cancel_button", cancel_event)
+    dpg.hide_item("scan_button")
+    dpg.show_item("cancel_button")
+    scan_thread = threading.Thread(target=run_scan, args=(cancel_event,), daemon=True)
+    dpg.set_item_user_data("scan_button", scan_thread)
+    scan_thread.start()
+
+
+def run_scan(cancel_event):
+    """Scan the selected directory, then bring back the scan button."""
+    try:
+        scan_directory(cancel_event)
+    finally:
+        dpg.hide_item("cancel_button")
+        dpg.show_item("scan_button")
+
+
+def cancel_scan(_, __, cancel_event):
+    """Callback to stop the running scan."""
+    cancel_event.set()
+
+
+def stop_scan():
+    """Cancel the running scan, if any, and wait for it to finish."""
+    scan_thread = dpg.get_item_user_data("scan_button")
+    if scan_thread is not None:
+        dpg.get_item_user_data("cancel_button").set()
+        scan_thread.join()
+
+
+def scan_directory(cancel_event):
     """Scan the selected directory and display the contents."""
 
     directory_path = dpg.get_value("directory_text").replace("Selected Directory: ", "")
@@ -78,114 +603,84 @@ def scan_directory():
     if dpg.does_item_exist("directory_contents"):
         dpg.delete_item("directory_contents")
 
-    hashes = {}
-    duplicates = {}
-
     # Create a new table to display directory contents
     with dpg.child_window(
         width=-1, height=-1, parent="__main_window", tag="directory_contents"
     ):
-        # Count total files for progress tracking
+        cancelled = cancel_event.is_set
+
+        # Only files of the same size can be duplicates
         dpg.add_text("Indexing files...", tag="scanning_text")
-        total_files = sum(len(files) for _, _, files in os.walk(directory_path))
-        processed_files = 0
+        files = index_files(directory_path, cancelled)
+        candidates = find_candidates(files.sizes)
         dpg.delete_item("scanning_text")
 
         # Create a progress bar
         progress_bar_tag = dpg.add_progress_bar(width=-1, label="Scanning...")
-        progress_text_tag = dpg.add_text(f"Processed: {processed_files}/{total_files}")
-
-        # Walk through the directory and calculate the hash of each file
-        for root, _, files in os.walk(directory_path):
-            for file in files:
-                filehash = xxprehashsum(os.path.join(root, file))
-                relative_path = os.path.relpath(
-                    os.path.join(root, file), directory_path
-                )
-                if filehash in hashes:
-                    # Calculate the relative path
-                    duplicates[filehash] = duplicates.get(filehash, []) + [
-                        relative_path
-                    ]
-                else:
-                    hashes[filehash] = relative_path
-
-                # Refresh the screen
-                processed_files += 1
-                progress_percentage = processed_files / total_files
-                dpg.set_value(progress_bar_tag, progress_percentage)
-                dpg.set_value(
-                    progress_text_tag,
-                    f"Processed: {processed_files}/{total_files}",
-                )
-
-        # Recheck with full hash
-        dpg.add_text("Rechecking duplicates...", tag="rechecking_text")
-        true_duplicates = {}
-        for filehash, paths in duplicates.items():
-            if filehash not in hashes:
-                continue
-
-            all_paths = [
-                os.path.join(directory_path, path)
-                for path in paths + [hashes[filehash]]
-            ]
-
-            # Get full hash for first file
-            first_path = all_paths[0]
-            full_hash = xxhashsum(first_path)
-            matches = [first_path]
-
-            # Compare other files against full hash
-            for path in all_paths[1:]:
-                if xxhashsum(path) == full_hash:
-                    matches.append(path)
-
-            if len(matches) > 1:  # Only store if actual duplicates found
-                true_duplicates[full_hash] = matches
-
-        dpg.delete_item("rechecking_text")
-
-        # Sort duplicates by file size
-        file_sizes = {
-            filehash: os.path.getsize(
-                os.path.join(directory_path, true_duplicates[filehash][0])
-            )
-            for filehash in true_duplicates
-        }
-        sorted_duplicates = sorted(
-            true_duplicates.items(), key=lambda item: file_sizes[item[0]], reverse=True
+        progress_text_tag = dpg.add_text(f"Processed: 0/{len(candidates)}")
+        report_progress = progress_reporter(
+            progress_bar_tag, progress_text_tag, len(candidates)
         )
 
-        # Display found duplicates in a table
-        dpg.set_value(progress_text_tag, f"Processed: {total_files} files")
-        with dpg.table(header_row=True, scrollX=True, scrollY=True):
-            dpg.add_table_column(label="File Size", width=10, width_fixed=True)
-            dpg.add_table_column(label="File Paths")
-            # dpg.add_table_column(label="Duplicate File Hash", width=10, width_fixed=True)
-
-            # Populate the table with relative file paths and additional file info
-            for filehash, paths in sorted_duplicates:
-                file_size = file_sizes[filehash]
-
-                if file_size == 0:
-                    continue  # Skip zero-byte files
-
-                with dpg.table_row():
-                    dpg.add_text(format_filesize(file_size))  # Display file size in KB
-                    dpg.add_text(
-                        ", ".join(
-                            [os.path.basename(path) for path in paths]
-                        ),  # Display the first 24 characters of each path
-                        tag=filehash,
-                    )
-                    # dpg.add_text(filehash)
+        # Reuse the hashes of files that didn't change since the last scan
+        cache = open_hash_cache()
+        try:
+            prehashed, uncached = [], candidates
+            if cache is not None:
+                prehashed, uncached = load_cached_hashes(
+                    cache, files, candidates, cancelled
+                )
+            report_progress(len(prehashed))
 
-                    with dpg.tooltip(filehash):
-                        dpg.add_text("\n".join(paths))
+            # Cached files without a full hash, the recheck may fill it in
+            unfinished = [i for i in prehashed if files.fullhashes[i] is None]
 
-        # Remove the progress bar
-        dpg.delete_item(progress_bar_tag)
+            # Pre-hash the files that weren't cached
+            prehashes, partial_hashes = prehash_files(
+                files, uncached, cancelled, report_progress
+            )
+            for index, prehash in prehashes.items():
+                files.prehashes[index] = prehash
+                prehashed.append(index)
+            report_progress(0, force=True)
+
+            # Recheck files with a matching pre-hash using the full hash
+            duplicate_groups = []
+            if not cancelled():
+                dpg.add_text("Rechecking duplicates...", tag="rechecking_text")
+                prehash_groups = group_prehashes(
+                    prehashed, files.sizes, files.prehashes
+                )
+                recheck = find_recheck(files, prehash_groups)
+                fullhashes = full_hash_files(files, recheck, partial_hashes, cancelled)
+                for index, fullhash in fullhashes.items():
+                    files.fullhashes[index] = fullhash
+                duplicate_groups = group_duplicates(files, prehash_groups)
+                dpg.delete_item("rechecking_text")
+
+            if cancelled():
+                dpg.set_value(progress_text_tag, "Scan cancelled.")
+            else:
+                dpg.set_value(progress_text_tag, f"Processed: {len(files.paths)} files")
+                show_duplicates(files, duplicate_groups)
+
+            # Remove the progress bar
+            dpg.delete_item(progress_bar_tag)
+
+            # Save the hashes computed by this scan, even if it was cancelled
+            if cache is not None:
+                updated = list(prehashes)
+                updated += (i for i in unfinished if files.fullhashes[i] is not None)
+                store_cached_hashes(
+                    cache,
+                    files,
+                    updated,
+                    # A cancelled scan may not have indexed every file
+                    prune_directory=None if cancelled() else directory_path,
+                )
+        finally:
+            if cache is not None:
+                cache.close()
 
 
 def main():
@@ -208,7 +703,10 @@ def main():
         dpg.add_text("Selected Directory:", tag="directory_label")
         dpg.add_text("No directory selected.", tag="directory_text")
 
-        dpg.add_button(label="Scan", callback=scan_directory)
+        dpg.add_button(label="Scan", callback=start_scan, tag="scan_button")
+        dpg.add_button(
+            label="Cancel", callback=cancel_scan, tag="cancel_button", show=False
+        )
 
 
 if __name__ == "__main__":
@@ -230,4 +728,7 @@ if __name__ == "__main__":
     dpg.setup_dearpygui()
     dpg.show_viewport()
     dpg.start_dearpygui()
+
+    # The scan thread still uses the context, stop it before destroying it
+    stop_scan()
     dpg.destroy_context()